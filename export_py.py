@@ -1,10 +1,26 @@
 import argparse
-import websocket
-import struct
+import asyncio
+import io
+import websockets
 import numpy as np
 import time
 import os
-from scipy.ndimage import label, generate_binary_structure
+import queue
+import signal
+import socket
+import threading
+
+# uvloop est optionnel : boucle d'événements plus rapide que celle d'asyncio
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Numba est optionnel : sans lui, on se rabat sur scipy.ndimage.label
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 # --- Command-line arguments ---
 parser = argparse.ArgumentParser(
@@ -20,78 +36,258 @@ parser.add_argument(
     default="./dataset_thermique",
     help="Directory to save .npy frame files (default: ./dataset_thermique)",
 )
+parser.add_argument(
+    "--max-frames",
+    type=int,
+    default=0,
+    help="Record up to N frames into a single memory-mapped .npy file with a CSV of "
+         "statistics, instead of one .npy file per frame (default: 0, disabled)",
+)
 args = parser.parse_args()
 
 SAVE_DIR = args.output
 os.makedirs(SAVE_DIR, exist_ok=True)
 
+# Mode fichier unique : les trames sont copiées dans un .npy mappé en mémoire et
+# leurs statistiques ajoutées à un CSV, sans créer un fichier par trame
+if args.max_frames > 0:
+    session = time.strftime("%Y%m%d_%H%M%S")
+    FRAMES_PATH = f"{SAVE_DIR}/frames_{session}.npy"
+    frames = np.lib.format.open_memmap(FRAMES_PATH, mode="w+", dtype=np.float32,
+                                       shape=(args.max_frames, 24, 32))
+    # Écriture ligne par ligne : une ligne par trame, rien n'est perdu en cas d'arrêt brutal
+    stats_file = open(f"{SAVE_DIR}/frames_{session}.csv", "w", buffering=1)
+    stats_file.write("frame,temp_min,temp_max,nb_personnes,nb_points_chauds\n")
+else:
+    frames = None
+
 # Compteur pour la séquence des fichiers
 frame_counter = 0
 
-def on_message(ws, message):
+# File des trames à écrire : la sauvegarde sur disque est faite par un thread
+# dédié pour ne pas bloquer la réception WebSocket
+save_queue = queue.Queue(maxsize=256)
+
+def save_worker():
+    while True:
+        filename, matrix = save_queue.get()
+        try:
+            np.save(filename, matrix)
+        except OSError as e:
+            print(f"Erreur d'écriture : {filename} ({e})")
+        finally:
+            save_queue.task_done()
+
+def close_frames():
+    # Réécrit l'en-tête et tronque le fichier au nombre de trames réellement reçues
+    global frames
+    count = min(frame_counter, args.max_frames)
+    descr = np.lib.format.dtype_to_descr(frames.dtype)
+    offset = frames.offset
+    frame_nbytes = frames[0].nbytes
+    frames.flush()
+    stats_file.close()
+
+    # Le mappage doit être libéré avant de tronquer le fichier (refusé sinon sous Windows)
+    frames = None
+
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(
+        header, {"descr": descr, "fortran_order": False, "shape": (count, 24, 32)}
+    )
+    if header.tell() != offset:
+        print(f"En-tête non réécrit : {FRAMES_PATH} garde {args.max_frames} trames, dont {count} valides")
+        return
+
+    with open(FRAMES_PATH, "r+b") as f:
+        f.write(header.getvalue())
+        f.truncate(offset + count * frame_nbytes)
+
+# Masques des personnes et des points chauds juxtaposés, séparés par une colonne
+# toujours vide pour que leurs zones ne puissent pas se toucher
+masques = np.zeros((24, 2 * 32 + 1), dtype=bool)
+
+if njit is not None:
+    @njit(cache=True)
+    def _racine(parent, i):
+        # Recherche de la racine avec compression de chemin (path halving)
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    @njit(cache=True)
+    def _unir(parent, i, j):
+        ri = _racine(parent, i)
+        rj = _racine(parent, j)
+        if ri < rj:
+            parent[rj] = ri
+        elif rj < ri:
+            parent[ri] = rj
+
+    @njit(cache=True)
+    def compter_zones(masques, largeur_gauche):
+        # Étiquetage en une passe par union-find, connexité 8 : seuls les voisins
+        # déjà parcourus (haut-gauche, haut, haut-droite, gauche) sont examinés
+        hauteur, largeur = masques.shape
+        parent = np.arange(hauteur * largeur)
+        for y in range(hauteur):
+            for x in range(largeur):
+                if not masques[y, x]:
+                    continue
+                i = y * largeur + x
+                if x > 0 and masques[y, x - 1]:
+                    _unir(parent, i, i - 1)
+                if y > 0:
+                    for dx in range(-1, 2):
+                        if 0 <= x + dx < largeur and masques[y - 1, x + dx]:
+                            _unir(parent, i, i - largeur + dx)
+
+        # Une zone par racine ; son côté indique sa classe
+        nb_gauche = 0
+        nb_droite = 0
+        for y in range(hauteur):
+            for x in range(largeur):
+                i = y * largeur + x
+                if masques[y, x] and _racine(parent, i) == i:
+                    if x < largeur_gauche:
+                        nb_gauche += 1
+                    else:
+                        nb_droite += 1
+        return nb_gauche, nb_droite
+
+    # Compilation dès le démarrage plutôt qu'à la première trame, pour ne pas
+    # bloquer la boucle de réception (et ses pings) pendant la compilation JIT
+    compter_zones(masques, 32)
+else:
+    from scipy.ndimage import label, generate_binary_structure
+
+    # Structure de connexion (permet de lier les pixels en diagonale)
+    structure = generate_binary_structure(2, 2)
+
+    def compter_zones(masques, largeur_gauche):
+        # Un seul étiquetage pour les deux moitiés : les zones de gauche sont
+        # comptées à part, toutes les autres sont à droite
+        etiquettes, nb_zones = label(masques, structure)
+        nb_gauche = np.count_nonzero(np.unique(etiquettes[:, :largeur_gauche]))
+        return nb_gauche, nb_zones - nb_gauche
+
+def on_message(message):
+    # Renvoie True quand le fichier mappé est plein et que la capture doit s'arrêter
     global frame_counter
 
     # On vérifie qu'on reçoit bien les 3072 octets (768 pixels * 4 octets)
     if len(message) == 3072:
-        # Décodage du binaire brut (Little-Endian) vers un tuple de 768 floats
-        data = struct.unpack('<768f', message)
-
-        # Conversion en matrice 2D (24 lignes, 32 colonnes)
-        matrix = np.array(data, dtype=np.float32).reshape((24, 32))
+        # Décodage du binaire brut (Little-Endian) directement en matrice 2D
+        # (24 lignes, 32 colonnes), sans passer par un tuple Python intermédiaire
+        matrix = np.frombuffer(message, dtype='<f4', count=768).reshape((24, 32))
 
         # Extraction de la température minimum et maximum
         temp_min = np.min(matrix)
         temp_max = np.max(matrix)
 
-        # Définition de la structure de connexion (permet de lier les pixels en diagonale)
-        structure = generate_binary_structure(2, 2)
-
         # --- DÉTECTION DU NOMBRE DE PERSONNES (entre 25.0°C et 33.0°C) ---
         # On utilise l'opérateur bitwise '&' pour combiner les deux conditions NumPy
-        masque_personne = (matrix >= 25.0) & (matrix <= 33.0)
-        _, nb_personnes = label(masque_personne, structure)
+        masques[:, :32] = (matrix >= 25.0) & (matrix <= 33.0)
 
         # --- DÉTECTION DES POINTS CHAUDS (> 33.0°C) ---
         seuil_point_chaud = 33.0
-        masque_point_chaud = matrix > seuil_point_chaud
-        _, nb_points_chauds = label(masque_point_chaud, structure)
+        masques[:, 33:] = matrix > seuil_point_chaud
+
+        # Un seul étiquetage pour les deux masques : les zones de gauche sont
+        # des personnes, toutes les autres sont des points chauds
+        nb_personnes, nb_points_chauds = compter_zones(masques, 32)
         # ----------------------------------------
 
-        # Sauvegarde avec l'ajout du nombre de personnes et de points chauds dans le nom de fichier
-        filename = f"{SAVE_DIR}/frame_{temp_min:.1f}_{temp_max:.1f}_{nb_personnes}_{nb_points_chauds}_{frame_counter}.npy"
-        np.save(filename, matrix)
+        if frames is not None:
+            # Simple copie dans le fichier mappé, les statistiques vont dans le CSV
+            frames[frame_counter] = matrix
+            stats_file.write(f"{frame_counter},{temp_min:.1f},{temp_max:.1f},{nb_personnes},{nb_points_chauds}\n")
 
-        print(f"Sauvegarde : {filename} | Personnes (25-33°C) : {nb_personnes} | Points chauds (>33°C) : {nb_points_chauds}")
+            print(f"Trame {frame_counter} : {FRAMES_PATH} | Personnes (25-33°C) : {nb_personnes} | Points chauds (>33°C) : {nb_points_chauds}")
+        else:
+            # Sauvegarde avec l'ajout du nombre de personnes et de points chauds dans le nom de fichier
+            filename = f"{SAVE_DIR}/frame_{temp_min:.1f}_{temp_max:.1f}_{nb_personnes}_{nb_points_chauds}_{frame_counter}.npy"
+            # La matrice est une vue sur le message (bytes immuable) : pas besoin de copie
+            try:
+                save_queue.put_nowait((filename, matrix))
+            except queue.Full:
+                # On privilégie le temps réel : la trame est abandonnée plutôt que d'attendre le disque
+                print(f"Trame ignorée : file de sauvegarde pleine ({filename})")
+            else:
+                print(f"Sauvegarde : {filename} | Personnes (25-33°C) : {nb_personnes} | Points chauds (>33°C) : {nb_points_chauds}")
 
         frame_counter += 1
+        return frames is not None and frame_counter >= args.max_frames
     else:
         print(f"Trame ignorée : taille incorrecte ({len(message)} octets)")
+        return False
 
-def on_error(ws, error):
-    error_msg = str(error).lower()
-    if "rsv is not implemented" in error_msg:
+def on_error(error):
+    # Une désynchronisation (bits RSV invalides) ferme la connexion avec le code 1002
+    # (erreur de protocole)
+    if (isinstance(error, websockets.exceptions.ConnectionClosedError)
+            and error.sent is not None
+            and error.sent.code == 1002):
         print("⚠️ Perte de synchronisation réseau. Reconnexion en cours...")
+    elif isinstance(error, asyncio.TimeoutError):
+        print("Erreur WebSocket : pas de réponse du serveur (délai dépassé)")
     else:
         print(f"Erreur WebSocket : {error}")
 
-def on_close(ws, close_status_code, close_msg):
-    print("Connexion fermée. Reconnexion dans 5 secondes...")
-    time.sleep(5)
-    start_capture()
+async def open_socket():
+    # Options appliquées avant la connexion : Nagle désactivé pour que les petits paquets
+    # (pong, fermeture) partent sans attendre, et tampon de réception agrandi à 1 Mo
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    sock.setblocking(False)
+    try:
+        await asyncio.get_running_loop().sock_connect(sock, (args.ip, 81))
+    except OSError:
+        sock.close()
+        raise
+    return sock
 
-def start_capture():
+async def start_capture():
     ws_url = f"ws://{args.ip}:81/"
-    print(f"Connexion à {ws_url}...")
 
-    ws = websocket.WebSocketApp(ws_url,
-                              on_message=on_message,
-                              on_error=on_error,
-                              on_close=on_close)
+    while True:
+        print(f"Connexion à {ws_url}...")
+        try:
+            # Pas de compression : les floats bruts se compressent mal et coûtent du CPU
+            async with websockets.connect(ws_url, sock=await open_socket(), max_size=4096,
+                                          compression=None, ping_interval=10, ping_timeout=5) as ws:
+                async for message in ws:
+                    if on_message(message):
+                        # Fin normale de la session (code 1000) : le fichier mappé est plein
+                        await ws.close()
+                        print(f"Capacité atteinte ({args.max_frames} trames) : fin de la capture")
+                        return
+        # asyncio.TimeoutError (délai de l'ouverture) n'hérite d'OSError qu'à partir de Python 3.11
+        except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as error:
+            on_error(error)
 
-    # Conservation des paramètres optimisés pour le flux binaire
-    ws.run_forever(skip_utf8_validation=True, ping_interval=10, ping_timeout=5)
+        print("Connexion fermée. Reconnexion dans 5 secondes...")
+        await asyncio.sleep(5)
 
 if __name__ == "__main__":
     print("--- Démarrage de la capture du dataset thermique ---")
     print(f"Les matrices seront sauvegardées dans : {os.path.abspath(SAVE_DIR)}")
-    start_capture()
+    threading.Thread(target=save_worker, daemon=True).start()
+
+    # SIGTERM suit le même chemin d'arrêt que Ctrl+C, pour finaliser les fichiers
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    try:
+        if uvloop is not None:
+            uvloop.run(start_capture())
+        else:
+            asyncio.run(start_capture())
+    except KeyboardInterrupt:
+        print("Arrêt de la capture")
+    finally:
+        # On termine l'écriture des trames encore en attente avant de quitter
+        save_queue.join()
+        if frames is not None:
+            close_frames()